@@ -1,11 +1,29 @@
 from django.contrib import admin
+from django.urls import reverse
 from solo.admin import SingletonModelAdmin
-from callrouting.models import Shift, Volunteer, EmailState, UserGroup, Call
+from callrouting.ical import feed_token
+from callrouting.models import Shift, Volunteer, EmailState, UserGroup, Call, BlockedCaller, InboundNumber
 
 # Register your models here.
 
+class VolunteerAdmin(admin.ModelAdmin):
+    readonly_fields = ['calendar_feed']
+
+    def calendar_feed(self, volunteer):
+        if volunteer.pk is None:
+            return '-'
+        return reverse('callrouting:shift_feed', args=(feed_token(volunteer),))
+
+class CallAdmin(admin.ModelAdmin):
+    readonly_fields = ['transcription_text']
+
+    def transcription_text(self, call):
+        return call.get_transcription_text() or '-'
+
 admin.site.register(Shift)
-admin.site.register(Volunteer)
+admin.site.register(Volunteer, VolunteerAdmin)
 admin.site.register(EmailState, SingletonModelAdmin)
 admin.site.register(UserGroup)
-admin.site.register(Call)
\ No newline at end of file
+admin.site.register(Call, CallAdmin)
+admin.site.register(BlockedCaller)
+admin.site.register(InboundNumber)
\ No newline at end of file
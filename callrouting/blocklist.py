@@ -0,0 +1,96 @@
+"""
+In-memory caller blocklist.
+
+Each worker holds the blocklist as a set of hashed (user group, number)
+keys with a Bloom filter in front of it. Almost every caller is not
+blocked, and the Bloom filter answers that without touching the set or the
+database. Blocked numbers are confirmed against the set.
+
+The database is only consulted to check BlocklistState.version, at most
+once every BLOCKLIST_REFRESH_SECONDS, and the list is reloaded only when
+the version has changed. Changes saved in this process reload the list
+straight away.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from callrouting.models import BlockedCaller, BlocklistState
+from callrouting.routing import normalise_number
+from callrouting.versioned import VersionedTable
+
+import hashlib
+import math
+
+# Key used for numbers blocked from every user group
+ALL_GROUPS = '*'
+
+
+def blocklist_key(user_group_id, number):
+    return hashlib.blake2b(f'{user_group_id}:{number}'.encode(), digest_size=16).digest()
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over blocklist keys, sized for a false positive
+    rate of error_rate at capacity entries.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        # Double hashing: derive all positions from the two halves of the key.
+        first = int.from_bytes(key[:8], 'little')
+        second = int.from_bytes(key[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class Blocklist(VersionedTable):
+    state_model = BlocklistState
+    refresh_setting = 'BLOCKLIST_REFRESH_SECONDS'
+    empty = (BloomFilter(0), frozenset())
+
+    def load(self):
+        keys = set()
+        for user_group_id, number in BlockedCaller.objects.values_list('user_group_id', 'number'):
+            keys.add(blocklist_key(user_group_id or ALL_GROUPS, normalise_number(number)))
+        bloom = BloomFilter(len(keys))
+        for key in keys:
+            bloom.add(key)
+        return bloom, frozenset(keys)
+
+    def is_blocked(self, user_group, number):
+        self.refresh()
+        bloom, keys = self.table
+        number = normalise_number(number)
+        for key in (blocklist_key(ALL_GROUPS, number), blocklist_key(user_group.id, number)):
+            if key in bloom and key in keys:
+                return True
+        return False
+
+
+blocklist = Blocklist()
+
+
+def is_blocked(user_group, number):
+    """
+    Is the caller on number blocked from calling user_group (or blocked from
+    every group)?
+    """
+    return blocklist.is_blocked(user_group, number)
+
+
+@receiver(post_save, sender=BlockedCaller)
+@receiver(post_delete, sender=BlockedCaller)
+def invalidate_blocklist(**kwargs):
+    blocklist.invalidate()
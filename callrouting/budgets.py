@@ -0,0 +1,196 @@
+"""
+Query and latency budgets for the call routing views and scheduled commands.
+
+Each entry in BUDGETS is the most database queries and wall time a single
+request (or command run) is allowed to use. The Twilio webhooks are on the
+path of a live phone call, so it should be an obvious, deliberate change to
+let them do more work.
+
+Tests enforce the budgets with BudgetTestMixin.assertWithinBudget, and
+BudgetMiddleware logs a warning in production whenever a request overruns.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from django.db import connection
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+Budget = namedtuple('Budget', ['queries', 'seconds'])
+
+# Keyed by URL name for views, and by command name for management commands.
+BUDGETS = {
+    'callrouting:index': Budget(queries=2, seconds=0.5),
+    # Includes the blocklist and routing version checks made periodically,
+    # and the statement timeout set on PostgreSQL
+    'callrouting:handle': Budget(queries=5, seconds=0.5),
+    'callrouting:volunteers': Budget(queries=4, seconds=1.0),
+    'callrouting:simulate': Budget(queries=6, seconds=2.0),
+    # Only the queries before streaming begins; the export itself is
+    # streamed after the response has left the middleware.
+    'callrouting:export': Budget(queries=3, seconds=0.5),
+    'callrouting:shift_feed': Budget(queries=3, seconds=0.5),
+    'callrouting:recording': Budget(queries=2, seconds=0.5),
+    'callrouting:recordingcomplete': Budget(queries=8, seconds=0.5),
+    'callrouting:transcription': Budget(queries=8, seconds=0.5),
+    'sendschedules': Budget(queries=5, seconds=10.0),
+}
+
+# Savepoint bookkeeping depends on how deeply transactions happen to be
+# nested (e.g. inside a TestCase), so it isn't counted against a budget.
+IGNORED_PREFIXES = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+# How many frames of stack to keep when sampling an overrun.
+STACK_LIMIT = 20
+
+
+def counts_against_budget(sql):
+    return not sql.lstrip().upper().startswith(IGNORED_PREFIXES)
+
+
+class BudgetTracker:
+    """
+    Database execute wrapper that records the queries run and the time taken
+    while it is installed.
+
+    A stack sample is taken at the first query over the query budget, and
+    (once arm_deadline has been called) of the thread doing the work when
+    the time budget runs out, so that an overrun can be traced back to the
+    code responsible, whether or not it was running a query at the time.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.queries = []
+        self.stack = None
+        self.deadline_stack = None
+        self.timer = None
+        self.started = time.monotonic()
+        self.elapsed = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.monotonic() - start
+            if counts_against_budget(sql):
+                self.queries.append(sql)
+                if self.budget is not None and len(self.queries) == self.budget.queries + 1:
+                    self.stack = ''.join(traceback.format_stack(limit=STACK_LIMIT)[:-1])
+
+    def arm_deadline(self):
+        """
+        Sample the stack of the current thread if it is still running when
+        the time budget runs out.
+        """
+        if self.budget is None:
+            return
+        remaining = self.budget.seconds - (time.monotonic() - self.started)
+        self.timer = threading.Timer(max(remaining, 0), self.sample_deadline_stack,
+                                     args=(threading.get_ident(),))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def sample_deadline_stack(self, thread_id):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            self.deadline_stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT))
+
+    def stop(self):
+        self.elapsed = time.monotonic() - self.started
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def exceeded(self):
+        if self.budget is None:
+            return False
+        return len(self.queries) > self.budget.queries or self.elapsed > self.budget.seconds
+
+    def log_if_exceeded(self, name):
+        if not self.exceeded():
+            return
+        stack = self.stack
+        if self.elapsed > self.budget.seconds and self.deadline_stack:
+            stack = self.deadline_stack
+        logger.warning(
+            f'Budget exceeded for {name}: {len(self.queries)}/{self.budget.queries} queries, '
+            f'{self.elapsed:.3f}/{self.budget.seconds:.3f}s',
+            extra={
+                'budget_name': name,
+                'queries': len(self.queries),
+                'query_budget': self.budget.queries,
+                'seconds': round(self.elapsed, 6),
+                'seconds_budget': self.budget.seconds,
+                'sql': self.queries,
+                'stack': stack,
+            })
+
+
+@contextmanager
+def track_budget(name):
+    """
+    Track the queries and time used by the enclosed block, logging a warning
+    if it exceeds the budget registered under name.
+    """
+    tracker = BudgetTracker(BUDGETS.get(name))
+    tracker.arm_deadline()
+    try:
+        with connection.execute_wrapper(tracker):
+            yield tracker
+    finally:
+        tracker.stop()
+        tracker.log_if_exceeded(name)
+
+
+class BudgetMiddleware:
+    """
+    Log a warning for any request that exceeds the budget of the view it
+    resolved to. Requests for views without a budget are not checked.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tracker = BudgetTracker()
+        request.budget_tracker = tracker
+        try:
+            with connection.execute_wrapper(tracker):
+                response = self.get_response(request)
+        finally:
+            tracker.stop()
+        match = request.resolver_match
+        if match is not None and tracker.budget is not None:
+            tracker.log_if_exceeded(match.view_name)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        tracker = getattr(request, 'budget_tracker', None)
+        if tracker is not None:
+            tracker.budget = BUDGETS.get(request.resolver_match.view_name)
+            tracker.arm_deadline()
+
+
+class BudgetTestMixin:
+    """
+    TestCase mixin for asserting that a block stays within a named budget.
+    On failure the offending SQL is listed in the assertion message.
+    """
+
+    @contextmanager
+    def assertWithinBudget(self, name):
+        budget = BUDGETS[name]
+        tracker = BudgetTracker(budget)
+        with connection.execute_wrapper(tracker):
+            yield tracker
+        tracker.stop()
+        queries = '\n'.join(f'{i}. {sql}' for i, sql in enumerate(tracker.queries, start=1))
+        self.assertLessEqual(len(tracker.queries), budget.queries,
+            f'{name} ran {len(tracker.queries)} queries, budget is {budget.queries}:\n{queries}')
+        self.assertLessEqual(tracker.elapsed, budget.seconds,
+            f'{name} took {tracker.elapsed:.3f}s, budget is {budget.seconds}s:\n{queries}')
@@ -0,0 +1,116 @@
+"""
+Streaming export of call history as CSV or JSON lines.
+
+Calls are read in chunks ordered by (time, sid), each chunk starting after
+the last row of the one before (keyset pagination). Memory use stays the
+same however many calls are exported, and no chunk query gets slower the
+further into the export it is, as it would with OFFSET. The transcripts for
+each chunk are fetched with one further query.
+"""
+from django.db.models import Q
+
+from callrouting.models import Call, Transcript
+
+import csv
+import datetime
+import json
+import pytz
+
+FIELDS = [
+    'sid',
+    'time',
+    'caller_number',
+    'called_number',
+    'recording_begun',
+    'recording_received',
+    'recording_url',
+    'transcription_received',
+    'transcription_successful',
+    'transcription_text',
+    'email_attempted',
+    'email_send_time',
+    'email_send_finished',
+]
+
+# Everything but the transcription text is read from Call itself
+CALL_FIELDS = [field for field in FIELDS if field != 'transcription_text']
+
+CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def date_range(start_date, end_date):
+    """
+    Return the start and end times covering the whole of the days from
+    start_date to end_date inclusive, in UK time.
+    """
+    tz = pytz.timezone('Europe/London')
+    start = tz.localize(datetime.datetime.combine(start_date, datetime.time()))
+    end = tz.localize(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+    return start, end
+
+
+def iter_calls(user_group, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Yield a dict of FIELDS for each call to user_group between start
+    (inclusive) and end (exclusive), oldest first.
+    """
+    calls = Call.objects.filter(user_group=user_group, time__gte=start, time__lt=end).order_by('time', 'sid')
+    after = Q()
+    while True:
+        chunk = list(calls.filter(after).values(*CALL_FIELDS)[:chunk_size])
+        transcripts = dict(Transcript.objects.filter(call_id__in=[row['sid'] for row in chunk])
+                           .values_list('call_id', 'compressed_text'))
+        for row in chunk:
+            row['transcription_text'] = Transcript.decompress(transcripts.get(row['sid']))
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        after = Q(time__gt=last['time']) | Q(time=last['time'], sid__gt=last['sid'])
+
+
+def serialise(value):
+    if value is None:
+        return None
+    if isinstance(value, (bool, int, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+class Echo:
+    """File-like object that returns what is written, for use with csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([serialise(row[field]) for field in FIELDS])
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps({field: serialise(row[field]) for field in FIELDS}) + '\n'
+
+
+def export_lines(user_group, start, end, format):
+    """
+    Return an iterator of lines exporting calls in the given format, which
+    must be one of FORMATS.
+    """
+    rows = iter_calls(user_group, start, end)
+    if format == 'csv':
+        return csv_lines(rows)
+    if format == 'jsonl':
+        return jsonl_lines(rows)
+    raise ValueError(f'Unknown export format {format}')
@@ -0,0 +1,122 @@
+"""
+iCalendar feeds of a volunteer's upcoming shifts.
+
+Shifts are a weekly pattern, so the feed expands them into dated events
+over a rolling window of SHIFT_FEED_DAYS from today. Feeds are addressed
+by a signed token rather than a login, so that calendar apps can poll them.
+
+Polling is made cheap by conditional GET: the ETag and Last-Modified of a
+feed come from one query for the volunteer's feed_updated time, which is
+moved on whenever one of their shifts is saved or deleted, and the rendered
+feed is cached under its ETag, so it is only rendered again once the feed
+changes or the window moves on a day.
+"""
+from django.conf import settings
+from django.core import signing
+
+from callrouting.models import Volunteer
+
+import datetime
+import hashlib
+import pytz
+
+signer = signing.Signer(salt='callrouting.shift_feed')
+
+PRODID = '-//Community Line//Shift Feed//EN'
+
+
+def feed_token(volunteer):
+    return signer.sign(str(volunteer.id))
+
+
+def volunteer_id_from_token(token):
+    """
+    Return the volunteer id a feed token was issued for, or raise
+    signing.BadSignature if it wasn't issued by us.
+    """
+    return int(signer.unsign(token))
+
+
+def window_start():
+    return datetime.datetime.now(pytz.timezone('Europe/London')).date()
+
+
+def feed_state(volunteer_id, start_date):
+    """
+    Return the ETag and Last-Modified time of a volunteer's feed for the
+    window starting at start_date, or None if there is no such volunteer.
+    """
+    state = (Volunteer.objects.filter(id=volunteer_id)
+             .values_list('feed_updated', 'name', 'user_group__name').first())
+    if state is None:
+        return None
+    feed_updated, name, user_group_name = state
+    midnight = pytz.timezone('Europe/London').localize(datetime.datetime.combine(start_date, datetime.time()))
+    last_modified = max(feed_updated, midnight)
+    # The names are shown in the feed, so a rename changes it even if it
+    # was made without saving the volunteer or group
+    key = f'{volunteer_id}:{start_date}:{feed_updated}:{name}:{user_group_name}'
+    return hashlib.sha1(key.encode()).hexdigest(), last_modified
+
+
+def escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Fold a content line to at most 75 octets, as RFC 5545 requires."""
+    encoded = line.encode()
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        # Don't split a multi-byte character
+        while cut and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+    parts.append(encoded.decode())
+    return '\r\n '.join(parts)
+
+
+def utc_stamp(moment):
+    return moment.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def render_feed(volunteer, shifts, start_date, days, last_modified):
+    """
+    Render the shifts (a weekly pattern) as an iCalendar feed of events on
+    each of the days from start_date onwards.
+    """
+    tz = pytz.timezone('Europe/London')
+    shifts_by_day = {}
+    for shift in shifts:
+        shifts_by_day.setdefault(shift.day, []).append(shift)
+
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{escape(f"Community Line shifts for {volunteer.name}")}',
+    ]
+    for offset in range(days):
+        date = start_date + datetime.timedelta(days=offset)
+        for shift in shifts_by_day.get(date.strftime('%A'), []):
+            start = tz.localize(datetime.datetime.combine(date, datetime.time(shift.start_time)))
+            end = tz.localize(datetime.datetime.combine(date, datetime.time(shift.end_time)))
+            lines += [
+                'BEGIN:VEVENT',
+                f'UID:shift-{shift.id}-{date:%Y%m%d}@communityline',
+                f'DTSTAMP:{utc_stamp(last_modified)}',
+                f'DTSTART:{utc_stamp(start)}',
+                f'DTEND:{utc_stamp(end)}',
+                f'SUMMARY:{escape(f"{shift.user_group} phone shift")}',
+                'END:VEVENT',
+            ]
+    lines.append('END:VCALENDAR')
+    return ''.join(fold(line) + '\r\n' for line in lines)
+
+
+def feed_days():
+    return getattr(settings, 'SHIFT_FEED_DAYS', 28)
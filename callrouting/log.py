@@ -0,0 +1,132 @@
+"""
+Structured logging that stays off the request path.
+
+Records are put on an in-memory queue by the handler installed in
+settings.LOGGING, and a background listener thread formats them as JSON
+lines and writes them to stdout. A slow log drain then holds up the
+listener rather than the worker answering Twilio.
+
+The CallSid and UserGroup of the call being handled are attached to every
+record logged while handling it, see bind_log_context.
+"""
+from contextvars import ContextVar
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+_log_context = ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else was passed in extra.
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message'}
+
+
+def bind_log_context(**fields):
+    """
+    Attach fields (e.g. call_sid, user_group) to all records logged for the
+    rest of the current request.
+    """
+    _log_context.set(dict(_log_context.get(), **fields))
+
+
+class LogContextFilter(logging.Filter):
+    """
+    Copy the bound log context onto each record. This has to run in the
+    thread that logged the record, so it belongs on the queue handler.
+    """
+
+    def filter(self, record):
+        for name, value in _log_context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format a record as a single JSON object, including any extra fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that keeps the message and traceback in separate fields
+    rather than flattening them into one string, so the listener can still
+    format the record as JSON.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def queue_handler(stream=None):
+    """
+    Handler factory for settings.LOGGING: returns a StructuredQueueHandler
+    and starts a listener thread writing JSON lines to stream (stdout by
+    default).
+    """
+    log_queue = queue.Queue()
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JSONFormatter())
+    listener = logging.handlers.QueueListener(log_queue, target)
+    listener.start()
+    atexit.register(listener.stop)
+    handler = StructuredQueueHandler(log_queue)
+    handler.listener = listener
+    return handler
+
+
+class RequestLogMiddleware:
+    """
+    Bind the Twilio CallSid (if any) to the log context for the request,
+    and log how long the request took.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.logger = logging.getLogger(__name__)
+
+    def __call__(self, request):
+        token = _log_context.set({})
+        call_sid = request.POST.get('CallSid') if request.method == 'POST' else None
+        if call_sid:
+            bind_log_context(call_sid=call_sid)
+        start = time.monotonic()
+        try:
+            response = self.get_response(request)
+            self.logger.info(f'{request.method} {request.path} {response.status_code}', extra={
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round((time.monotonic() - start) * 1000, 3),
+            })
+            return response
+        finally:
+            _log_context.reset(token)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from callrouting.export import FORMATS, date_range, export_lines
+from callrouting.models import UserGroup
+import datetime
+
+
+class Command(BaseCommand):
+    help = "Writes the call history of a user group to stdout as CSV or JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_group_id', type=int)
+        parser.add_argument('--start', type=datetime.date.fromisoformat, required=True,
+            help='First day to export (YYYY-MM-DD)')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, required=True,
+            help='Last day to export (YYYY-MM-DD)')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+
+    def handle(self, *args, **options):
+        try:
+            user_group = UserGroup.objects.get(id=options['user_group_id'])
+        except UserGroup.DoesNotExist:
+            raise CommandError('No user group with id %s' % options['user_group_id'])
+
+        start, end = date_range(options['start'], options['end'])
+        for line in export_lines(user_group, start, end, options['format']):
+            self.stdout.write(line, ending='')
@@ -1,12 +1,12 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.template.loader import render_to_string
+from callrouting.budgets import track_budget
 from callrouting.models import EmailState, Shift, hour_labels
 import datetime
 import logging
-import sys
+import time
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 class Command(BaseCommand):
     help = "Emails tomorrow's volunteers information about their schedule"
@@ -15,6 +15,11 @@ class Command(BaseCommand):
         """Can add arguments here, but not needed so far for sending schedules."""
 
     def handle(self, *args, **options):
+        with track_budget('sendschedules'):
+            self.send_schedules()
+
+    def send_schedules(self):
+        started = time.monotonic()
         logger.info('Schedule sending process beginning...')
         email_state = EmailState.get_solo()
         # Check if there's a send already in progress
@@ -48,13 +53,16 @@ class Command(BaseCommand):
 
         # Get all shifts for tomorrow
         tomorrow_string = (today + datetime.timedelta(days=1)).strftime('%A')
-        tomorrow_shifts = Shift.objects.filter(day__exact=tomorrow_string)
+        tomorrow_shifts = Shift.objects.filter(day__exact=tomorrow_string
+                                               ).select_related('volunteer', 'user_group')
 
         # Log the list of shifts and volunteers, and whether they will receive email
         logger.info("Tomorrow's shifts:")
         for shift in tomorrow_shifts:
             send_emails = shift.volunteer.send_emails
-            logger.info('- %s / send email: %s' % (shift, send_emails))
+            logger.info('- %s / send email: %s' % (shift, send_emails), extra={
+                'shift': shift.id, 'volunteer': shift.volunteer_id,
+                'user_group': shift.user_group_id, 'send_emails': send_emails})
         
         # Create a list of emails - aggregate all shifts for each volunteer who
         # wants to receive mail
@@ -69,7 +77,8 @@ class Command(BaseCommand):
                 existing_shifts.append(shift)
         
         for volunteer, shift_list in volunteer_shifts.items():
-            print("Volunteer %s has %s" % (volunteer, ','.join(['%s' % s for s in shift_list])))
+            logger.info("Volunteer %s has %s" % (volunteer, ','.join(['%s' % s for s in shift_list])),
+                        extra={'volunteer': volunteer.id, 'shifts': len(shift_list)})
                 
         # Send email to each volunteer who has it enabled - format the template and send
         # - Log the emails that actually get sent: one at a time
@@ -83,7 +92,8 @@ class Command(BaseCommand):
                 'shift_list': shift_list,
             }
             text = render_to_string('callrouting/shift_email.html', context)
-            print(text)
+            logger.debug('Rendered schedule email', extra={
+                'volunteer': volunteer.id, 'shifts': len(shifts), 'email_text': text})
         # Log that we're going to update the emails sent date
         # Update the emails sent date
 
@@ -93,4 +103,5 @@ class Command(BaseCommand):
         email_state.save()
 
         # Log that we've completed the process
-        logger.info('Email send process completed.')
\ No newline at end of file
+        logger.info('Email send process completed.',
+                    extra={'duration_ms': round((time.monotonic() - started) * 1000, 3)})
\ No newline at end of file
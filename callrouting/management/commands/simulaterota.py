@@ -0,0 +1,53 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from callrouting.models import UserGroup
+from callrouting.simulation import call_demand, check_forwarded_per_hour, current_rota, parse_rota, simulate
+import datetime
+import json
+import pytz
+
+
+class Command(BaseCommand):
+    help = "Replays historical calls against the current rota and any proposed rotas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_group_id', type=int)
+        parser.add_argument('rotas', nargs='*',
+            help='JSON files, each a list of {"volunteer", "day", "start_time", "end_time"} shifts')
+        parser.add_argument('--days', type=int, default=365,
+            help='How many days of call history to replay (default 365)')
+        parser.add_argument('--forwarded-per-hour', type=float, default=0.0,
+            help='Modelled forwarded calls per hour, since only voicemail calls are logged')
+
+    def handle(self, *args, **options):
+        try:
+            user_group = UserGroup.objects.get(id=options['user_group_id'])
+        except UserGroup.DoesNotExist:
+            raise CommandError('No user group with id %s' % options['user_group_id'])
+
+        try:
+            forwarded_per_hour = check_forwarded_per_hour(options['forwarded_per_hour'])
+        except ValidationError as exc:
+            raise CommandError(exc.messages[0])
+
+        candidates = [('current', current_rota(user_group))]
+        for path in options['rotas']:
+            try:
+                with open(path) as f:
+                    candidates.append((path, parse_rota(user_group, json.load(f))))
+            except (OSError, ValueError, ValidationError) as exc:
+                raise CommandError('Could not load rota %s: %s' % (path, exc))
+
+        end = datetime.datetime.now(pytz.timezone('Europe/London'))
+        start = end - datetime.timedelta(days=options['days'])
+        demand = call_demand(user_group, start, end, forwarded_per_hour)
+
+        self.stdout.write('%s: %.0f calls from %s to %s' % (user_group, sum(demand.values()),
+                                                            start.date(), end.date()))
+        for name, shifts in candidates:
+            result = simulate(user_group, shifts, demand)
+            self.stdout.write('%s: answered %.1f%%, default destination %.1f%%, voicemail %.1f%%' % (
+                name, result['answer_rate'] * 100, result['default_destination_rate'] * 100,
+                result['voicemail_rate'] * 100))
+            for volunteer, calls in result['load']:
+                self.stdout.write('- %s: %.0f calls' % (volunteer, calls))
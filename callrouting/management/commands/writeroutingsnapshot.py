@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from callrouting.snapshot import SnapshotWriter, snapshot_path, write_snapshot
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Writes the on-disk routing snapshot used when the database is unavailable"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Where to write the snapshot (default ROUTING_SNAPSHOT_PATH)')
+        parser.add_argument('--watch', action='store_true',
+            help='Keep running, rewriting the snapshot whenever routing data changes')
+
+    def handle(self, *args, **options):
+        path = options['path'] or snapshot_path()
+        if options['watch']:
+            self.watch(SnapshotWriter(path))
+        else:
+            write_snapshot(path)
+            self.stdout.write('Routing snapshot written to %s' % path)
+
+    def watch(self, writer):
+        """
+        Check for changes every ROUTING_REFRESH_SECONDS. A failed write (e.g.
+        because the database is down at startup) is tried again at the next
+        check, so the snapshot catches up once the database is back.
+        """
+        while True:
+            close_old_connections()
+            try:
+                writer.reload_if_changed()
+            except Exception:
+                logger.exception('Could not write routing snapshot')
+            time.sleep(writer.refresh_interval())
@@ -1,9 +1,15 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
+from django.core.validators import RegexValidator
 from solo.models import SingletonModel
 from phonenumber_field.modelfields import PhoneNumberField
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 import datetime
+import zlib
 
 # Create your models here.
 
@@ -42,6 +48,9 @@ class Volunteer(models.Model):
     email = models.EmailField()
     send_emails = models.BooleanField(default=True)
     user_group = models.ForeignKey(UserGroup, on_delete=models.CASCADE)
+    # For telling when the volunteer's calendar feed needs to change: set on
+    # save, and by the signals below when their shifts or user group change
+    feed_updated = models.DateTimeField('Feed updated', auto_now=True)
 
     def __str__(self):
         return self.name
@@ -103,6 +112,14 @@ class Shift(models.Model):
     end_time = models.IntegerField(choices=ShiftHour.choices)
     user_group = models.ForeignKey(UserGroup, on_delete=models.CASCADE)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        shift = super().from_db(db, field_names, values)
+        # So that moving a shift to another volunteer also changes the feed
+        # of the volunteer it was moved from
+        shift.loaded_volunteer_id = shift.__dict__.get('volunteer_id')
+        return shift
+
     def clean(self):
         if self.user_group != self.volunteer.user_group:
             raise ValidationError('User group of shift must match user group')
@@ -112,6 +129,20 @@ class Shift(models.Model):
         end = hour_labels[self.end_time]
         return "%s: %s, %s %s-%s" % (self.user_group, self.volunteer, self.day, start, end)
 
+def touch_feeds(volunteers):
+    volunteers.update(feed_updated=timezone.now())
+
+@receiver(post_save, sender=Shift)
+@receiver(post_delete, sender=Shift)
+def shift_feed_changed(instance, **kwargs):
+    volunteer_ids = {instance.volunteer_id, getattr(instance, 'loaded_volunteer_id', None)}
+    touch_feeds(Volunteer.objects.filter(id__in=volunteer_ids - {None}))
+
+@receiver(post_save, sender=UserGroup)
+def user_group_feeds_changed(instance, **kwargs):
+    # The group's name appears in its volunteers' feeds
+    touch_feeds(Volunteer.objects.filter(user_group=instance))
+
 class Call(models.Model):
     user_group = models.ForeignKey(UserGroup, on_delete=models.CASCADE)
 
@@ -127,12 +158,101 @@ class Call(models.Model):
     recording_url = models.URLField('Recording URL', null=True)
     transcription_received = models.BooleanField('Transcription received', default=False)
     transcription_successful = models.BooleanField('Transcription successful', default=False)
-    transcription_text = models.CharField('Transcription text', max_length=8192, null=True)
+    # The transcription text itself is a Transcript, so that it is only
+    # loaded when it is needed
 
     # Email properties
     email_attempted = models.BooleanField('Email attempted', default=False)
     email_send_time = models.DateTimeField('Email send time', null=True)
     email_send_finished = models.BooleanField('Email send finished', default=False)
 
+    class Meta:
+        indexes = [
+            # For exporting a group's calls in (time, sid) order
+            models.Index(fields=['user_group', 'time', 'sid']),
+        ]
+
     def __str__(self):
         return f'{self.time}: {self.sid}'
+
+    def get_transcription_text(self):
+        """
+        Fetch the transcription text, or None if there isn't one.
+        """
+        compressed = Transcript.objects.filter(call=self).values_list('compressed_text', flat=True).first()
+        return Transcript.decompress(compressed)
+
+class Transcript(models.Model):
+    call = models.OneToOneField(Call, on_delete=models.CASCADE, primary_key=True)
+    # zlib-compressed UTF-8 text
+    compressed_text = models.BinaryField('Compressed text')
+
+    @staticmethod
+    def compress(text):
+        return zlib.compress(text.encode())
+
+    @staticmethod
+    def decompress(compressed):
+        if compressed is None:
+            return None
+        return zlib.decompress(compressed).decode()
+
+    @property
+    def text(self):
+        return self.decompress(self.compressed_text)
+
+    def __str__(self):
+        return f'Transcript of {self.call_id}'
+
+class BlocklistState(SingletonModel):
+    # Bumped whenever the blocklist changes, so that workers know to reload it.
+    version = models.PositiveIntegerField(default=0)
+
+class BlockedCaller(models.Model):
+    number = PhoneNumberField('Caller Number')
+    # Blank to block the caller from every user group
+    user_group = models.ForeignKey(UserGroup, on_delete=models.CASCADE, null=True, blank=True)
+    reason = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField('Created', auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.number} ({self.user_group or "all groups"})'
+
+def bump_version(state_model):
+    state = state_model.get_solo()
+    state_model.objects.filter(pk=state.pk).update(version=F('version') + 1)
+
+@receiver(post_save, sender=BlockedCaller)
+@receiver(post_delete, sender=BlockedCaller)
+def bump_blocklist_version(**kwargs):
+    bump_version(BlocklistState)
+
+class RoutingState(SingletonModel):
+    # Bumped whenever the mapping of incoming numbers to user groups, the
+    # user groups themselves, or the volunteers and shifts in the routing
+    # snapshot change, so that workers know to reload them.
+    version = models.PositiveIntegerField(default=0)
+
+class InboundNumber(models.Model):
+    user_group = models.ForeignKey(UserGroup, on_delete=models.CASCADE, related_name='inbound_numbers')
+    number = models.CharField('Number or prefix', max_length=16, validators=[
+        RegexValidator(r'^\+[1-9][0-9]{0,14}$', 'Enter a number or prefix in E.164 format, e.g. +4415221')])
+    is_prefix = models.BooleanField('Prefix', default=False,
+        help_text='Route every number beginning with this prefix to the user group')
+
+    class Meta:
+        unique_together = [['number', 'is_prefix']]
+
+    def __str__(self):
+        return f'{self.number}{"*" if self.is_prefix else ""} ({self.user_group})'
+
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+@receiver(post_save, sender=InboundNumber)
+@receiver(post_delete, sender=InboundNumber)
+@receiver(post_save, sender=Volunteer)
+@receiver(post_delete, sender=Volunteer)
+@receiver(post_save, sender=Shift)
+@receiver(post_delete, sender=Shift)
+def bump_routing_version(**kwargs):
+    bump_version(RoutingState)
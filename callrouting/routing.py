@@ -0,0 +1,98 @@
+"""
+In-memory lookup of the user group an incoming call is for.
+
+Each worker holds a hash map from E.164 number to UserGroup, covering every
+group's incoming_number and its exact InboundNumbers, and a trie of the
+InboundNumber prefixes. A call is routed by one dict lookup, falling back
+to the longest matching prefix, without querying the database.
+
+As with the blocklist, the database is only consulted to check
+RoutingState.version at most once every ROUTING_REFRESH_SECONDS, and the
+table is reloaded only when the version has changed. Changes saved in this
+process reload the table straight away.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from phonenumber_field.phonenumber import PhoneNumber, to_python
+
+from callrouting.models import InboundNumber, RoutingState, UserGroup
+from callrouting.versioned import VersionedTable
+
+# Trie key under which the user group for a prefix is stored. Never a digit.
+GROUP = ''
+
+
+def normalise_number(number):
+    """
+    Return number in E.164 format if it can be parsed, otherwise unchanged
+    (Twilio sends e.g. 'anonymous' for withheld numbers).
+    """
+    phone_number = to_python(number)
+    if isinstance(phone_number, PhoneNumber) and phone_number.is_valid():
+        return phone_number.as_e164
+    return str(number)
+
+
+def add_prefix(trie, prefix, user_group):
+    node = trie
+    for digit in prefix.lstrip('+'):
+        node = node.setdefault(digit, {})
+    node[GROUP] = user_group
+
+
+def longest_prefix(trie, number):
+    node = trie
+    found = trie.get(GROUP)
+    for digit in number.lstrip('+'):
+        node = node.get(digit)
+        if node is None:
+            break
+        found = node.get(GROUP, found)
+    return found
+
+
+class NumberRouter(VersionedTable):
+    state_model = RoutingState
+    refresh_setting = 'ROUTING_REFRESH_SECONDS'
+    empty = ({}, {})
+
+    def load(self):
+        numbers = {}
+        trie = {}
+        for user_group in UserGroup.objects.all():
+            numbers[normalise_number(user_group.incoming_number)] = user_group
+        # Each number brings its own group, so that a group created since
+        # the query above can't leave a number without one.
+        for inbound_number in InboundNumber.objects.select_related('user_group'):
+            if inbound_number.is_prefix:
+                add_prefix(trie, inbound_number.number, inbound_number.user_group)
+            else:
+                numbers[normalise_number(inbound_number.number)] = inbound_number.user_group
+        return numbers, trie
+
+    def lookup(self, number):
+        self.refresh()
+        numbers, trie = self.table
+        number = normalise_number(number)
+        user_group = numbers.get(number)
+        if user_group is None:
+            user_group = longest_prefix(trie, number)
+        return user_group
+
+
+router = NumberRouter()
+
+
+def find_user_group(number):
+    """
+    Return the UserGroup that calls to number should be routed to, or None.
+    """
+    return router.lookup(number)
+
+
+@receiver(post_save, sender=UserGroup)
+@receiver(post_delete, sender=UserGroup)
+@receiver(post_save, sender=InboundNumber)
+@receiver(post_delete, sender=InboundNumber)
+def invalidate_router(**kwargs):
+    router.invalidate()
@@ -0,0 +1,151 @@
+"""
+What-if simulation of a rota against historical call demand.
+
+Call demand is bucketed once into the 168 (day, hour) slots of a week, and
+each rota is reduced to the volunteer who would be chosen in each slot. A
+rota is then evaluated slot by slot rather than call by call, so a year of
+calls against several candidate rotas costs one aggregate query plus a few
+hundred additions per rota.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import Count
+from django.db.models.functions import ExtractHour, ExtractWeekDay
+
+from callrouting.models import Call, Shift, UserGroup, Volunteer
+
+from collections import Counter
+import datetime
+import math
+import pytz
+
+DAYS = Shift.ShiftDay.values
+
+# ExtractWeekDay numbers days from Sunday (1) to Saturday (7).
+WEEKDAY_NAMES = {1: 'Sunday', 2: 'Monday', 3: 'Tuesday', 4: 'Wednesday',
+                 5: 'Thursday', 6: 'Friday', 7: 'Saturday'}
+
+
+def call_demand(user_group, start, end, forwarded_per_hour=0.0):
+    """
+    Return a Counter of calls to user_group between start and end, keyed by
+    (day, hour) in UK time.
+
+    Only calls that went to voicemail are recorded as Call rows, so forwarded
+    calls are modelled as arriving at forwarded_per_hour during every hour
+    that shifts can cover.
+    """
+    tz = pytz.timezone('Europe/London')
+    rows = (Call.objects
+            .filter(user_group=user_group, time__gte=start, time__lt=end)
+            .annotate(weekday=ExtractWeekDay('time', tzinfo=tz), hour=ExtractHour('time', tzinfo=tz))
+            .values('weekday', 'hour')
+            .annotate(calls=Count('sid'))
+            .order_by())
+    demand = Counter()
+    for row in rows:
+        demand[WEEKDAY_NAMES[row['weekday']], row['hour']] += row['calls']
+
+    if forwarded_per_hour:
+        weeks = (end - start) / datetime.timedelta(weeks=1)
+        for day in DAYS:
+            for hour in Shift.ShiftHour.values:
+                demand[day, hour] += forwarded_per_hour * weeks
+    return demand
+
+
+def build_coverage(shifts):
+    """
+    Return a dict mapping (day, hour) to the volunteer who would take a call
+    in that slot.
+
+    As in get_current_volunteer, a shift covers the hours from its start up
+    to but excluding its end, and where shifts overlap the first one wins.
+    """
+    coverage = {}
+    for shift in shifts:
+        for hour in range(shift.start_time, shift.end_time):
+            coverage.setdefault((shift.day, hour), shift.volunteer)
+    return coverage
+
+
+def simulate(user_group, shifts, demand):
+    """
+    Evaluate a rota against call demand, returning the number of calls that
+    would reach a volunteer, the default destination or voicemail, and the
+    load on each volunteer.
+    """
+    coverage = build_coverage(shifts)
+    load = Counter()
+    unanswered = 0
+    for slot, calls in demand.items():
+        volunteer = coverage.get(slot)
+        if volunteer is None:
+            unanswered += calls
+        else:
+            load[volunteer] += calls
+
+    total = sum(demand.values())
+    answered = sum(load.values())
+    if user_group.default_action == UserGroup.DefaultAction.VOICEMAIL:
+        default_destination, voicemail = 0, unanswered
+    else:
+        default_destination, voicemail = unanswered, 0
+
+    def rate(calls):
+        return calls / total if total else 0.0
+
+    return {
+        'calls': total,
+        'answered': answered,
+        'default_destination': default_destination,
+        'voicemail': voicemail,
+        'answer_rate': rate(answered),
+        'default_destination_rate': rate(default_destination),
+        'voicemail_rate': rate(voicemail),
+        'load': load.most_common(),
+    }
+
+
+def current_rota(user_group):
+    return list(Shift.objects.filter(user_group=user_group).select_related('volunteer').order_by('pk'))
+
+
+def check_forwarded_per_hour(forwarded_per_hour):
+    """
+    Raise ValidationError unless forwarded_per_hour is a finite, non-negative
+    rate.
+    """
+    if not math.isfinite(forwarded_per_hour) or forwarded_per_hour < 0:
+        raise ValidationError(f'Forwarded calls per hour must be a number of at least 0, not {forwarded_per_hour}')
+    return forwarded_per_hour
+
+
+def parse_rota(user_group, entries):
+    """
+    Build unsaved Shifts for user_group from a list of dicts with volunteer
+    (id), day, start_time and end_time keys, validating them as the admin
+    would. Raises ValidationError if any entry is invalid.
+    """
+    if not isinstance(entries, list):
+        raise ValidationError('A rota must be a list of shifts')
+    volunteers = Volunteer.objects.filter(user_group=user_group).in_bulk()
+    shifts = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValidationError(f'Rota entry {entry} is not a shift')
+        try:
+            volunteer = volunteers.get(int(entry['volunteer']))
+            shift = Shift(volunteer=volunteer, user_group=user_group, day=entry['day'],
+                          start_time=int(entry['start_time']), end_time=int(entry['end_time']))
+        except KeyError as exc:
+            raise ValidationError(f'Rota entry {entry} is missing {exc.args[0]}')
+        except (TypeError, ValueError):
+            raise ValidationError(f'Rota entry {entry} is not valid')
+        if volunteer is None:
+            raise ValidationError(f'Rota entry {entry} is not for a volunteer in {user_group}')
+        # The volunteer and user group have been checked above, so don't
+        # query for them again.
+        volunteer.user_group = user_group
+        shift.full_clean(exclude=['volunteer', 'user_group'])
+        shifts.append(shift)
+    return shifts
@@ -0,0 +1,198 @@
+"""
+On-disk snapshot of everything needed to route a call, for when the
+database is slow or down.
+
+The snapshot holds every user group's greetings and default action, the
+numbers and prefixes routed to it, and for each of the 168 hours of the
+week the number of the volunteer who would take the call there (first shift
+wins, as in get_current_volunteer).
+
+The snapshot is a file on the local disk, so every host (dyno) keeps its
+own: `writeroutingsnapshot --watch` runs alongside the web server and
+rewrites it atomically whenever RoutingState.version changes, which any
+change to that data bumps. Each worker parses the file again only when it
+has been replaced.
+
+handle runs its database work under ROUTING_DB_TIMEOUT_MS and routes from
+the snapshot if the database fails, so callers are still forwarded during
+database incidents.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+
+from callrouting.models import InboundNumber, RoutingState, Shift, UserGroup
+from callrouting.routing import add_prefix, longest_prefix, normalise_number
+from callrouting.versioned import VersionedTable
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+HOURS_PER_DAY = 24
+
+
+def snapshot_path():
+    return settings.ROUTING_SNAPSHOT_PATH
+
+
+def build_snapshot():
+    """
+    Return the routing snapshot as a JSON-serialisable dict.
+    """
+    groups = {}
+    numbers = {}
+    for user_group in UserGroup.objects.all():
+        groups[str(user_group.id)] = {
+            'name': user_group.name,
+            'greeting': user_group.greeting,
+            'default_action': user_group.default_action,
+            'default_destination': normalise_number(user_group.default_destination) or None,
+            'voicemail_greeting': user_group.voicemail_greeting,
+            'slots': {day: [None] * HOURS_PER_DAY for day in Shift.ShiftDay.values},
+        }
+        numbers[normalise_number(user_group.incoming_number)] = user_group.id
+
+    # A group committed after the query above is skipped in those below. Its
+    # creation bumped RoutingState.version, so the next snapshot includes it.
+    prefixes = {}
+    for user_group_id, number, is_prefix in InboundNumber.objects.values_list(
+            'user_group_id', 'number', 'is_prefix'):
+        if str(user_group_id) not in groups:
+            continue
+        if is_prefix:
+            prefixes[number] = user_group_id
+        else:
+            numbers[normalise_number(number)] = user_group_id
+
+    shifts = Shift.objects.values_list('user_group_id', 'day', 'start_time', 'end_time',
+                                       'volunteer__number').order_by('pk')
+    for user_group_id, day, start_time, end_time, volunteer_number in shifts:
+        if str(user_group_id) not in groups:
+            continue
+        slots = groups[str(user_group_id)]['slots'][day]
+        for hour in range(start_time, end_time):
+            if slots[hour] is None:
+                slots[hour] = normalise_number(volunteer_number)
+
+    return {
+        'version': SNAPSHOT_VERSION,
+        'groups': groups,
+        'numbers': numbers,
+        'prefixes': prefixes,
+    }
+
+
+def write_snapshot(path=None):
+    """
+    Write the routing snapshot, replacing any existing one atomically so
+    that readers never see a partly written file.
+    """
+    path = path or snapshot_path()
+    data = json.dumps(build_snapshot(), separators=(',', ':')).encode()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.routing-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    logger.info('Routing snapshot written', extra={'path': path, 'bytes': len(data)})
+
+
+class Snapshot:
+    """
+    A parsed routing snapshot: numbers and prefix trie to group, and each
+    group's routing details.
+    """
+
+    def __init__(self, data):
+        self.groups = data['groups']
+        self.numbers = data['numbers']
+        self.trie = {}
+        for prefix, user_group_id in data['prefixes'].items():
+            add_prefix(self.trie, prefix, user_group_id)
+
+    def find_user_group(self, number):
+        number = normalise_number(number)
+        user_group_id = self.numbers.get(number)
+        if user_group_id is None:
+            user_group_id = longest_prefix(self.trie, number)
+        if user_group_id is None:
+            return None
+        return self.groups.get(str(user_group_id))
+
+    def volunteer_number(self, user_group, day, hour):
+        return user_group['slots'][day][hour]
+
+
+class SnapshotReader:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.identity = None
+        self.snapshot = None
+
+    def read(self, path=None):
+        """
+        Return the current Snapshot, parsing the file again only if it has
+        been replaced since it was last read.
+        """
+        path = path or snapshot_path()
+        stat = os.stat(path)
+        identity = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if identity != self.identity:
+                with open(path, 'rb') as f:
+                    data = json.load(f)
+                if data.get('version') != SNAPSHOT_VERSION:
+                    raise ValueError(f'Unsupported routing snapshot version {data.get("version")}')
+                self.snapshot = Snapshot(data)
+                self.identity = identity
+            return self.snapshot
+
+
+reader = SnapshotReader()
+
+
+def read_snapshot():
+    return reader.read()
+
+
+@contextmanager
+def routing_db_timeout():
+    """
+    Run the enclosed database work in a transaction that fails quickly
+    (after ROUTING_DB_TIMEOUT_MS) on PostgreSQL rather than keeping a
+    caller waiting.
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [settings.ROUTING_DB_TIMEOUT_MS])
+        yield
+
+
+class SnapshotWriter(VersionedTable):
+    """
+    Rewrites the snapshot at path whenever RoutingState.version changes.
+    """
+    state_model = RoutingState
+    refresh_setting = 'ROUTING_REFRESH_SECONDS'
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+
+    def load(self):
+        write_snapshot(self.path)
+        return self.path
@@ -1,10 +1,39 @@
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core import mail
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from unittest import mock
+from datetime import date, datetime, timedelta
+from io import StringIO
+import atexit
+import contextvars
+import csv
+import json
+import logging
+import logging.handlers
+import os
+import pytz
+import tempfile
+import time
 
 # Create your tests here.
 
-from .models import Shift, Volunteer, UserGroup
+from .blocklist import BloomFilter, Blocklist, blocklist, blocklist_key
+from .budgets import Budget, BudgetTestMixin
+from .export import date_range, iter_calls
+from .ical import feed_token
+from .log import LogContextFilter, bind_log_context, queue_handler
+from .models import (Shift, Volunteer, UserGroup, Call, BlockedCaller, InboundNumber, RoutingState, Transcript,
+    bump_version)
+from .routing import NumberRouter, router
+from .snapshot import SnapshotWriter, build_snapshot, read_snapshot, write_snapshot
+from .simulation import call_demand, current_rota, parse_rota, simulate
 
 class ShiftTests(TestCase):
     pass
@@ -132,3 +161,722 @@ class ViewsRequiringLoginTests(TestCase):
         response = self.client.get(reverse('callrouting:volunteers', args=(ug_id, day, time)))
         self.assertEqual(response.status_code, 302)
         self.assertIn('login', response.url)
+
+
+def monday_morning():
+    return datetime(2020, 3, 23, 9, 30, tzinfo=pytz.timezone('Europe/London'))
+
+class BudgetTests(BudgetTestMixin, TestCase):
+    sid = 'CA' + '0' * 32
+
+    @classmethod
+    def setUpTestData(self):
+        User = get_user_model()
+        User.objects.create_user('temporary', 'temporary@domain.local', 'temporary')
+        self.user_group = create_one_user_group()
+
+    def setUp(self):
+        # Load the blocklist and routing table up front so that the version
+        # checks don't count against the budget of the request under test.
+        blocklist.refresh(force=True)
+        router.refresh(force=True)
+
+    def call_params(self, **extra):
+        params = {'CallSid': self.sid, 'From': '+441234000111', 'To': '+441522123456'}
+        params.update(extra)
+        return params
+
+    def test_handle_forward_within_budget(self):
+        create_shift_with_volunteer('Steve Smith', '+441234999888', 'Monday', 8, 11,
+            self.user_group, 'stevesmith@domain.local')
+        with mock.patch('callrouting.views.datetime') as mock_datetime:
+            mock_datetime.now.return_value = monday_morning()
+            with self.assertWithinBudget('callrouting:handle'):
+                response = self.client.post(reverse('callrouting:handle'), self.call_params())
+        self.assertContains(response, '+441234999888')
+
+    def test_handle_voicemail_within_budget(self):
+        with self.assertWithinBudget('callrouting:handle'):
+            response = self.client.post(reverse('callrouting:handle'), self.call_params())
+        self.assertContains(response, '<Record')
+
+    def test_voicemail_callbacks_within_budget(self):
+        self.client.post(reverse('callrouting:handle'), self.call_params())
+        with self.assertWithinBudget('callrouting:recording'):
+            self.client.post(reverse('callrouting:recording'), self.call_params())
+        with self.assertWithinBudget('callrouting:recordingcomplete'):
+            self.client.post(reverse('callrouting:recordingcomplete'),
+                self.call_params(RecordingUrl='https://api.twilio.com/recording'))
+        with self.assertWithinBudget('callrouting:transcription'):
+            self.client.post(reverse('callrouting:transcription'),
+                self.call_params(TranscriptionStatus='completed', TranscriptionText='Hello'))
+        self.assertTrue(Call.objects.get(sid=self.sid).email_send_finished)
+
+    def test_volunteers_within_budget(self):
+        for i in range(3):
+            create_shift_with_volunteer(f'Volunteer {i}', f'+44123499988{i}', 'Monday', 8, 11,
+                self.user_group, f'volunteer{i}@domain.local')
+        self.client.login(username='temporary', password='temporary')
+        with self.assertWithinBudget('callrouting:volunteers'):
+            response = self.client.get(reverse('callrouting:volunteers',
+                args=(self.user_group.id, 'Monday', 9)))
+        self.assertEqual(len(response.context['shifts']), 3)
+
+    def test_sendschedules_within_budget(self):
+        # sendschedules reads tomorrow's shifts
+        tomorrow = (date.today() + timedelta(days=1)).strftime('%A')
+        for i in range(3):
+            shift = create_shift_with_volunteer(f'Volunteer {i}', f'+44123499988{i}',
+                tomorrow, 8, 11, self.user_group, f'volunteer{i}@domain.local')
+            Volunteer.objects.filter(id=shift.volunteer_id).update(send_emails=False)
+        with self.assertWithinBudget('sendschedules'):
+            call_command('sendschedules')
+
+    def test_middleware_logs_overrun(self):
+        with mock.patch.dict('callrouting.budgets.BUDGETS',
+                             {'callrouting:handle': Budget(queries=0, seconds=0.5)}):
+            with self.assertLogs('callrouting.budgets', level='WARNING') as logs:
+                self.client.post(reverse('callrouting:handle'), self.call_params())
+        record = logs.records[0]
+        self.assertEqual(record.budget_name, 'callrouting:handle')
+        self.assertEqual(record.queries, 2)
+        self.assertIn('callrouting/views.py', record.stack)
+
+    def test_middleware_samples_slow_code_outside_database(self):
+        def slow_check(user_group, number):
+            time.sleep(0.2)
+            return False
+
+        with mock.patch.dict('callrouting.budgets.BUDGETS',
+                             {'callrouting:handle': Budget(queries=100, seconds=0.05)}), \
+                mock.patch('callrouting.views.is_blocked', side_effect=slow_check):
+            with self.assertLogs('callrouting.budgets', level='WARNING') as logs:
+                self.client.post(reverse('callrouting:handle'), self.call_params())
+        self.assertIn('in slow_check', logs.records[0].stack)
+
+
+class RotaSimulationTests(BudgetTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(self):
+        User = get_user_model()
+        User.objects.create_user('temporary', 'temporary@domain.local', 'temporary')
+        User.objects.create_user('staff', 'staff@domain.local', 'staff', is_staff=True)
+        self.user_group = create_one_user_group()
+        self.shift = create_shift_with_volunteer('Steve Smith', '+441234999888', 'Monday', 8, 11,
+            self.user_group, 'stevesmith@domain.local')
+        self.other = Volunteer.objects.create(name='Jane Jones', number='+441234999777',
+            user_group=self.user_group, email='janejones@domain.local')
+        # Three calls in the current shift on Monday morning, one on Tuesday afternoon.
+        london = pytz.timezone('Europe/London')
+        last_monday = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=7)
+        last_monday -= timedelta(days=last_monday.weekday())
+        times = [last_monday.replace(hour=9), last_monday.replace(hour=10),
+                 last_monday.replace(hour=10, minute=30), (last_monday + timedelta(days=1)).replace(hour=15)]
+        for i, time in enumerate(times):
+            Call.objects.create(user_group=self.user_group, sid=f'CA{i:032}',
+                caller_number='+441234000111', called_number='+441522123456')
+            Call.objects.filter(sid=f'CA{i:032}').update(time=london.localize(time))
+
+    def demand(self, forwarded_per_hour=0.0):
+        end = datetime.now(pytz.timezone('Europe/London'))
+        return call_demand(self.user_group, end - timedelta(days=365), end, forwarded_per_hour)
+
+    def test_current_rota(self):
+        result = simulate(self.user_group, current_rota(self.user_group), self.demand())
+        self.assertEqual(result['calls'], 4)
+        self.assertEqual(result['answered'], 3)
+        self.assertEqual(result['voicemail'], 1)
+        self.assertEqual(result['load'], [(self.shift.volunteer, 3)])
+
+    def test_proposed_rota(self):
+        shifts = parse_rota(self.user_group, [
+            {'volunteer': self.other.id, 'day': 'Monday', 'start_time': 10, 'end_time': 12},
+            {'volunteer': self.shift.volunteer.id, 'day': 'Monday', 'start_time': 8, 'end_time': 11},
+            {'volunteer': self.other.id, 'day': 'Tuesday', 'start_time': 14, 'end_time': 16},
+        ])
+        result = simulate(self.user_group, shifts, self.demand())
+        self.assertEqual(result['answer_rate'], 1.0)
+        self.assertEqual(dict(result['load']), {self.other: 3, self.shift.volunteer: 1})
+
+    def test_forwarded_call_model(self):
+        result = simulate(self.user_group, current_rota(self.user_group), self.demand(1.0))
+        weeks = 365 / 7
+        self.assertAlmostEqual(result['calls'], 4 + 7 * 18 * weeks)
+        self.assertAlmostEqual(result['answered'], 3 + 3 * weeks)
+
+    def test_invalid_rota(self):
+        for entry in ({'volunteer': self.other.id, 'day': 'Someday', 'start_time': 8, 'end_time': 9},
+                      {'volunteer': 0, 'day': 'Monday', 'start_time': 8, 'end_time': 9},
+                      {'volunteer': self.other.id, 'day': 'Monday', 'start_time': 8}):
+            with self.subTest(entry=entry):
+                with self.assertRaises(ValidationError):
+                    parse_rota(self.user_group, [entry])
+        for rota in (5, None, {'volunteer': self.other.id}, [5]):
+            with self.subTest(rota=rota):
+                with self.assertRaises(ValidationError):
+                    parse_rota(self.user_group, rota)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rota.json')
+            with open(path, 'w') as f:
+                json.dump([{'volunteer': self.other.id, 'day': 'Tuesday', 'start_time': 14,
+                            'end_time': 16}], f)
+            out = StringIO()
+            call_command('simulaterota', self.user_group.id, path, stdout=out)
+        self.assertIn('current: answered 75.0%, default destination 0.0%, voicemail 25.0%', out.getvalue())
+        self.assertIn(f'{path}: answered 25.0%, default destination 0.0%, voicemail 75.0%', out.getvalue())
+
+    def test_view_rejects_invalid_input(self):
+        self.client.login(username='staff', password='staff')
+        for data in ({'rota': '5'}, {'rota': 'null'}, {'forwarded_per_hour': 'inf'},
+                     {'forwarded_per_hour': 'nan'}, {'forwarded_per_hour': '-1'}):
+            with self.subTest(data=data):
+                response = self.client.post(reverse('callrouting:simulate', args=(self.user_group.id,)), data)
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNotNone(response.context['error'])
+                self.assertEqual(response.context['forwarded_per_hour'], 0.0)
+
+    def test_command_rejects_invalid_input(self):
+        with self.assertRaises(CommandError):
+            call_command('simulaterota', self.user_group.id, '--forwarded-per-hour', 'inf')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rota.json')
+            with open(path, 'w') as f:
+                f.write('5')
+            with self.assertRaises(CommandError):
+                call_command('simulaterota', self.user_group.id, path)
+
+    def test_view_needs_staff(self):
+        self.client.login(username='temporary', password='temporary')
+        response = self.client.get(reverse('callrouting:simulate', args=(self.user_group.id,)))
+        self.assertEqual(response.status_code, 302)
+
+    def test_view(self):
+        self.client.login(username='staff', password='staff')
+        rota = json.dumps([{'volunteer': self.other.id, 'day': 'Tuesday', 'start_time': 14, 'end_time': 16}])
+        with self.assertWithinBudget('callrouting:simulate'):
+            response = self.client.post(reverse('callrouting:simulate', args=(self.user_group.id,)),
+                {'rota': rota})
+        self.assertEqual([name for name, result in response.context['results']],
+                         ['Current rota', 'Proposed rota'])
+        self.assertContains(response, 'Jane Jones')
+
+
+class StructuredLoggingTests(TestCase):
+    sid = 'CA' + '0' * 32
+
+    def capture(self, logger_name):
+        handler = logging.handlers.BufferingHandler(100)
+        handler.addFilter(LogContextFilter())
+        logger = logging.getLogger(logger_name)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return handler.buffer
+
+    def test_queue_handler_writes_json_lines(self):
+        stream = StringIO()
+        handler = queue_handler(stream)
+        handler.addFilter(LogContextFilter())
+        logger = logging.getLogger('callrouting.tests.structured')
+        logger.addHandler(handler)
+        logger.propagate = False
+        self.addCleanup(setattr, logger, 'propagate', True)
+        self.addCleanup(logger.removeHandler, handler)
+
+        def log():
+            bind_log_context(call_sid=self.sid, user_group=1)
+            logger.info('Hello %s', 'world', extra={'duration_ms': 1.5})
+            try:
+                raise ValueError('oops')
+            except ValueError:
+                logger.exception('Failed')
+        contextvars.copy_context().run(log)
+        atexit.unregister(handler.listener.stop)
+        handler.listener.stop()
+
+        first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(first['message'], 'Hello world')
+        self.assertEqual(first['call_sid'], self.sid)
+        self.assertEqual(first['user_group'], 1)
+        self.assertEqual(first['duration_ms'], 1.5)
+        self.assertEqual(second['level'], 'ERROR')
+        self.assertIn('ValueError: oops', second['exception'])
+
+    def test_call_context_bound_in_webhooks(self):
+        user_group = create_one_user_group()
+        records = self.capture('callrouting.views')
+        self.client.post(reverse('callrouting:handle'),
+            {'CallSid': self.sid, 'From': '+441234000111', 'To': '+441522123456'})
+        self.assertEqual(records[-1].getMessage(), 'Sending call to voicemail')
+        self.assertEqual(records[-1].call_sid, self.sid)
+        self.assertEqual(records[-1].user_group, user_group.id)
+
+    def test_request_timing_logged(self):
+        create_one_user_group()
+        records = self.capture('callrouting.log')
+        self.client.post(reverse('callrouting:handle'),
+            {'CallSid': self.sid, 'From': '+441234000111', 'To': '+441522123456'})
+        self.assertEqual(records[-1].status, 200)
+        self.assertEqual(records[-1].call_sid, self.sid)
+        self.assertGreater(records[-1].duration_ms, 0)
+
+
+class CallExportTests(BudgetTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(self):
+        User = get_user_model()
+        User.objects.create_user('staff', 'staff@domain.local', 'staff', is_staff=True)
+        self.user_group = create_one_user_group()
+        other_group = create_one_user_group()
+        london = pytz.timezone('Europe/London')
+        # Five calls over two days, three of them at the same moment.
+        times = [datetime(2020, 3, 23, 9), datetime(2020, 3, 23, 12), datetime(2020, 3, 23, 12),
+                 datetime(2020, 3, 23, 12), datetime(2020, 3, 24, 23, 30)]
+        for i, time in enumerate(times):
+            Call.objects.create(user_group=self.user_group, sid=f'CA{4 - i:032}',
+                caller_number='+441234000111', called_number='+441522123456')
+            Call.objects.filter(sid=f'CA{4 - i:032}').update(time=london.localize(time))
+        Call.objects.create(user_group=other_group, sid='CA' + '9' * 32,
+            caller_number='+441234000111', called_number='+441522123456')
+        Call.objects.filter(sid='CA' + '9' * 32).update(time=london.localize(datetime(2020, 3, 23, 10)))
+        self.expected = [f'CA{i:032}' for i in (4, 1, 2, 3, 0)]
+
+    def export_url(self, **params):
+        params = dict({'start': '2020-03-23', 'end': '2020-03-24'}, **params)
+        return reverse('callrouting:export', args=(self.user_group.id,)) + '?' + '&'.join(
+            f'{key}={value}' for key, value in params.items())
+
+    def test_keyset_chunks(self):
+        start, end = date_range(date(2020, 3, 23), date(2020, 3, 24))
+        for chunk_size in (1, 2, 3, 5, 100):
+            with self.subTest(chunk_size=chunk_size):
+                rows = list(iter_calls(self.user_group, start, end, chunk_size=chunk_size))
+                self.assertEqual([row['sid'] for row in rows], self.expected)
+
+    def test_date_range(self):
+        start, end = date_range(date(2020, 3, 24), date(2020, 3, 24))
+        self.assertEqual([row['sid'] for row in iter_calls(self.user_group, start, end)],
+                         [f'CA{0:032}'])
+
+    def test_csv(self):
+        self.client.login(username='staff', password='staff')
+        with self.assertWithinBudget('callrouting:export'):
+            response = self.client.get(self.export_url())
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(line.decode() for line in response.streaming_content))
+        self.assertEqual([row['sid'] for row in rows], self.expected)
+        self.assertEqual(rows[0]['caller_number'], '+441234000111')
+        self.assertEqual(rows[0]['transcription_text'], '')
+
+    def test_jsonl(self):
+        self.client.login(username='staff', password='staff')
+        response = self.client.get(self.export_url(format='jsonl'))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['sid'] for row in rows], self.expected)
+        self.assertEqual(rows[0]['time'], '2020-03-23T09:00:00+00:00')
+        self.assertIsNone(rows[0]['transcription_text'])
+
+    def test_bad_request(self):
+        self.client.login(username='staff', password='staff')
+        for params in ({'start': 'yesterday'}, {'format': 'xml'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(self.export_url(**params)).status_code, 400)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('exportcalls', self.user_group.id, '--start', '2020-03-23', '--end', '2020-03-24',
+                     '--format', 'jsonl', stdout=out)
+        self.assertEqual([json.loads(line)['sid'] for line in out.getvalue().splitlines()], self.expected)
+
+
+class BlocklistTests(TestCase):
+    @classmethod
+    def setUpTestData(self):
+        self.user_group = create_one_user_group()
+        self.other_group = create_one_user_group()
+        self.other_group.incoming_number = '+441522654321'
+        self.other_group.save()
+
+    def setUp(self):
+        patcher = mock.patch('callrouting.blocklist.blocklist', Blocklist())
+        self.blocklist = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, caller, called='+441522123456'):
+        self.calls = getattr(self, 'calls', 0) + 1
+        return self.client.post(reverse('callrouting:handle'),
+            {'CallSid': f'CA{self.calls:032}', 'From': caller, 'To': called})
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        keys = [blocklist_key(1, f'+44123400{i:04}') for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(blocklist_key(2, f'+44123400{i:04}') in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    @override_settings(BLOCKLIST_REFRESH_SECONDS=0)
+    def test_blocked_callers_rejected(self):
+        BlockedCaller.objects.create(number='+441234000111', user_group=self.user_group)
+        BlockedCaller.objects.create(number='+441234000222')
+        for caller, called, blocked in (('+441234000111', '+441522123456', True),
+                                        ('+441234000111', '+441522654321', False),
+                                        ('+441234000222', '+441522654321', True),
+                                        ('+441234000333', '+441522123456', False)):
+            with self.subTest(caller=caller, called=called):
+                response = self.call(caller, called)
+                self.assertEqual(b'<Reject' in response.content, blocked)
+        self.assertFalse(Call.objects.filter(caller_number='+441234000111', called_number='+441522123456'))
+
+    @override_settings(BLOCKLIST_REFRESH_SECONDS=0)
+    def test_changes_picked_up(self):
+        self.assertNotContains(self.call('+441234000111'), '<Reject')
+        blocked = BlockedCaller.objects.create(number='+441234000111')
+        self.assertContains(self.call('+441234000111'), '<Reject')
+        blocked.delete()
+        self.assertNotContains(self.call('+441234000111'), '<Reject')
+
+    def test_version_checked_periodically(self):
+        self.blocklist.refresh()
+        with self.assertNumQueries(0):
+            self.assertFalse(self.blocklist.is_blocked(self.user_group, '+441234000111'))
+        with override_settings(BLOCKLIST_REFRESH_SECONDS=0):
+            with self.assertNumQueries(1):
+                self.assertFalse(self.blocklist.is_blocked(self.user_group, '+441234000111'))
+
+
+class NumberRoutingTests(TestCase):
+    @classmethod
+    def setUpTestData(self):
+        self.first = create_one_user_group()
+        self.second = create_one_user_group()
+        self.second.incoming_number = '+441522654321'
+        self.second.save()
+        InboundNumber.objects.create(user_group=self.first, number='+441522000001')
+        InboundNumber.objects.create(user_group=self.second, number='+4415229', is_prefix=True)
+        InboundNumber.objects.create(user_group=self.first, number='+44152299', is_prefix=True)
+
+    def setUp(self):
+        patcher = mock.patch('callrouting.routing.router', NumberRouter())
+        self.router = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup(self):
+        for number, user_group in (('+441522123456', self.first),
+                                   ('+441522654321', self.second),
+                                   ('+441522000001', self.first),
+                                   ('+441522900000', self.second),
+                                   ('+441522990000', self.first),
+                                   ('+441522800000', None),
+                                   ('anonymous', None)):
+            with self.subTest(number=number):
+                self.assertEqual(self.router.lookup(number), user_group)
+
+    def test_lookup_without_queries(self):
+        self.router.refresh()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.router.lookup('+441522900000'), self.second)
+
+    def test_changes_picked_up(self):
+        self.assertIsNone(self.router.lookup('+441522800000'))
+        number = InboundNumber.objects.create(user_group=self.second, number='+4415228', is_prefix=True)
+        self.assertEqual(self.router.lookup('+441522800000'), self.second)
+        number.delete()
+        self.assertIsNone(self.router.lookup('+441522800000'))
+
+    def test_remote_changes_picked_up(self):
+        self.router.refresh()
+        # A change made by another worker (update() sends no signals here)
+        # is only seen through the version.
+        InboundNumber.objects.filter(number='+4415229').update(user_group=self.first)
+        bump_version(RoutingState)
+        self.assertEqual(self.router.lookup('+441522900000'), self.second)
+        with override_settings(ROUTING_REFRESH_SECONDS=0):
+            self.assertEqual(self.router.lookup('+441522900000'), self.first)
+
+    def test_group_created_during_load(self):
+        # The group and its number are committed between the two queries of
+        # a reload, so the group isn't among those read first.
+        with mock.patch.object(UserGroup.objects, 'all', return_value=[]):
+            self.router.refresh()
+        self.assertEqual(self.router.lookup('+441522900000'), self.second)
+
+    def test_handle_routes_by_prefix(self):
+        response = self.client.post(reverse('callrouting:handle'),
+            {'CallSid': 'CA' + '0' * 32, 'From': '+441234000111', 'To': '+441522990000'})
+        self.assertContains(response, 'This is the test group voicemail')
+        self.assertEqual(Call.objects.get().user_group, self.first)
+
+
+@override_settings(SHIFT_FEED_DAYS=7)
+class ShiftFeedTests(BudgetTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(self):
+        self.user_group = create_one_user_group()
+        self.shift = create_shift_with_volunteer('Steve Smith', '+441234999888', 'Monday', 8, 11,
+            self.user_group, 'stevesmith@domain.local')
+        self.volunteer = self.shift.volunteer
+        Shift.objects.create(volunteer=self.volunteer, day='Thursday', start_time=18, end_time=21,
+            user_group=self.user_group)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('callrouting:shift_feed', args=(feed_token(self.volunteer),))
+
+    def events(self, response):
+        return response.content.decode().count('BEGIN:VEVENT')
+
+    def test_feed(self):
+        with self.assertWithinBudget('callrouting:shift_feed'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        content = response.content.decode()
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        # A week of a weekly pattern with two shifts
+        self.assertEqual(self.events(response), 2)
+        self.assertIn('SUMMARY:Test Group 1 (voicemail default) phone shift', content)
+
+    def test_expansion(self):
+        with mock.patch('callrouting.views.window_start', return_value=date(2020, 3, 23)):
+            with self.settings(SHIFT_FEED_DAYS=14):
+                content = self.client.get(self.url).content.decode()
+        self.assertIn('DTSTART:20200323T080000Z', content)
+        self.assertIn('DTEND:20200323T110000Z', content)
+        self.assertIn(f'UID:shift-{self.shift.id}-20200330@communityline', content)
+        # Shifts after the clocks go forward are an hour earlier in UTC
+        self.assertIn('DTSTART:20200402T170000Z', content)
+        self.assertEqual(content.count('BEGIN:VEVENT'), 4)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(1):
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_cached_until_shifts_change(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).content, response.content)
+
+        self.shift.delete()
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(self.events(changed), 1)
+
+    def test_if_modified_since_after_delete(self):
+        # Last-Modified has a resolution of a second, so start from a feed
+        # last changed an hour ago
+        Volunteer.objects.filter(id=self.volunteer.id).update(
+            feed_updated=datetime.now(pytz.utc) - timedelta(hours=1))
+        response = self.client.get(self.url)
+        self.shift.delete()
+        changed = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(self.events(changed), 1)
+
+    def test_moved_shift_changes_both_feeds(self):
+        other = Volunteer.objects.create(name='Jane Jones', number='+441234999777',
+            user_group=self.user_group, email='janejones@domain.local')
+        Volunteer.objects.update(feed_updated=datetime.now(pytz.utc) - timedelta(hours=1))
+        shift = Shift.objects.get(id=self.shift.id)
+        shift.volunteer = other
+        shift.save()
+        hour_ago = datetime.now(pytz.utc) - timedelta(minutes=59)
+        self.assertEqual(Volunteer.objects.filter(feed_updated__gt=hour_ago).count(), 2)
+
+    def test_renames_change_feed(self):
+        response = self.client.get(self.url)
+        UserGroup.objects.filter(id=self.user_group.id).update(name='Renamed Group')
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('SUMMARY:Renamed Group phone shift', changed.content.decode())
+
+        Volunteer.objects.filter(id=self.volunteer.id).update(name='Stephen Smith')
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=changed['ETag'])
+        self.assertIn('X-WR-CALNAME:Community Line shifts for Stephen Smith', changed.content.decode())
+
+    def test_bad_token(self):
+        for token in ('nonsense', feed_token(self.volunteer)[:-1], str(self.volunteer.id)):
+            with self.subTest(token=token):
+                response = self.client.get(reverse('callrouting:shift_feed', args=(token,)))
+                self.assertEqual(response.status_code, 404)
+
+
+class RoutingSnapshotTests(TestCase):
+    @classmethod
+    def setUpTestData(self):
+        self.voicemail_group = create_one_user_group()
+        self.forward_group = UserGroup.objects.create(name='Test Group 2 (forward default)',
+            incoming_number='+441522654321', greeting='Group two, please hold',
+            default_action=UserGroup.DefaultAction.DEFAULT_DESTINATION,
+            default_destination='+441522111111')
+        InboundNumber.objects.create(user_group=self.forward_group, number='+4415229', is_prefix=True)
+        create_shift_with_volunteer('Steve Smith', '+441234999888', 'Monday', 8, 11,
+            self.forward_group, 'stevesmith@domain.local')
+        create_shift_with_volunteer('Jane Jones', '+441234999777', 'Monday', 10, 12,
+            self.forward_group, 'janejones@domain.local')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'routing-snapshot.json')
+        override = self.settings(ROUTING_SNAPSHOT_PATH=self.path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def call(self, called, when):
+        with mock.patch('callrouting.views.find_user_group', side_effect=OperationalError('db down')), \
+                mock.patch('callrouting.views.datetime') as mock_datetime:
+            mock_datetime.now.return_value = when
+            return self.client.post(reverse('callrouting:handle'),
+                {'CallSid': 'CA' + '0' * 32, 'From': '+441234000111', 'To': called})
+
+    def test_build_snapshot(self):
+        snapshot = build_snapshot()
+        slots = snapshot['groups'][str(self.forward_group.id)]['slots']['Monday']
+        self.assertEqual(slots[7:13], [None, '+441234999888', '+441234999888', '+441234999888',
+                                       '+441234999777', None])
+        self.assertEqual(snapshot['numbers']['+441522654321'], self.forward_group.id)
+        self.assertEqual(snapshot['prefixes'], {'+4415229': self.forward_group.id})
+
+    def test_group_created_during_build(self):
+        # The group, its numbers and shifts are committed after the groups
+        # have been read
+        with mock.patch.object(UserGroup.objects, 'all',
+                               return_value=UserGroup.objects.filter(id=self.voicemail_group.id)):
+            snapshot = build_snapshot()
+        self.assertEqual(list(snapshot['groups']), [str(self.voicemail_group.id)])
+        self.assertEqual(snapshot['prefixes'], {})
+
+    def test_write_and_read(self):
+        write_snapshot()
+        first = read_snapshot()
+        self.assertIs(read_snapshot(), first)
+        self.assertEqual(first.find_user_group('+441522900000')['name'], 'Test Group 2 (forward default)')
+        self.assertIsNone(first.find_user_group('+441522800000'))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['routing-snapshot.json'])
+
+        self.forward_group.name = 'Renamed'
+        self.forward_group.save()
+        write_snapshot()
+        self.assertEqual(read_snapshot().find_user_group('+441522900000')['name'], 'Renamed')
+
+    def test_rewritten_when_version_changes(self):
+        writer = SnapshotWriter()
+        writer.reload_if_changed()
+        modified = os.stat(self.path).st_mtime_ns
+        with self.assertNumQueries(1):
+            writer.reload_if_changed()
+        self.assertEqual(os.stat(self.path).st_mtime_ns, modified)
+
+        Shift.objects.filter(volunteer__name='Jane Jones').delete()
+        Shift.objects.create(volunteer=Volunteer.objects.get(name='Jane Jones'), day='Tuesday',
+            start_time=9, end_time=10, user_group=self.forward_group)
+        writer.reload_if_changed()
+        slots = read_snapshot().find_user_group('+441522654321')['slots']
+        self.assertEqual(slots['Monday'][11], None)
+        self.assertEqual(slots['Tuesday'][9], '+441234999777')
+
+    def test_failed_write_retried(self):
+        writer = SnapshotWriter()
+        with mock.patch('callrouting.snapshot.build_snapshot', side_effect=OperationalError('db down')):
+            with self.assertRaises(OperationalError):
+                writer.reload_if_changed()
+        self.assertFalse(os.path.exists(self.path))
+        writer.reload_if_changed()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_fallback_voicemail_emailed(self):
+        write_snapshot()
+        sunday_night = datetime(2020, 3, 22, 21, tzinfo=pytz.timezone('Europe/London'))
+        self.call('+441522123456', sunday_night)
+        self.assertFalse(Call.objects.exists())
+
+        params = {'CallSid': 'CA' + '0' * 32, 'From': '+441234000111', 'To': '+441522123456'}
+        self.client.post(reverse('callrouting:recording'), params)
+        self.client.post(reverse('callrouting:recordingcomplete'),
+            dict(params, RecordingUrl='https://api.twilio.com/recording'))
+        self.client.post(reverse('callrouting:transcription'),
+            dict(params, TranscriptionStatus='completed', TranscriptionText='Hello'))
+        call = Call.objects.get()
+        self.assertEqual(call.user_group, self.voicemail_group)
+        self.assertTrue(call.email_send_finished)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['testgroup1@domain.local'])
+
+    def test_fallback_forwards_to_volunteer(self):
+        write_snapshot()
+        response = self.call('+441522654321', monday_morning())
+        self.assertContains(response, 'Group two, please hold')
+        self.assertContains(response, '<Dial>+441234999888</Dial>')
+
+    def test_fallback_default_actions(self):
+        write_snapshot()
+        sunday_night = datetime(2020, 3, 22, 21, tzinfo=pytz.timezone('Europe/London'))
+        self.assertContains(self.call('+441522900000', sunday_night), '<Dial>+441522111111</Dial>')
+        self.assertContains(self.call('+441522123456', sunday_night), 'This is the test group voicemail')
+
+    def test_fallback_without_snapshot(self):
+        with self.assertRaises(OperationalError):
+            self.call('+441522654321', monday_morning())
+
+
+class TranscriptTests(TestCase):
+    sid = 'CA' + '0' * 32
+    text = 'Hello, could someone call me back about my shopping please? ' * 20
+
+    @classmethod
+    def setUpTestData(self):
+        self.user_group = create_one_user_group()
+
+    def setUp(self):
+        params = {'CallSid': self.sid, 'From': '+441234000111', 'To': '+441522123456'}
+        self.client.post(reverse('callrouting:handle'), params)
+        self.client.post(reverse('callrouting:recording'), params)
+        self.client.post(reverse('callrouting:recordingcomplete'),
+            dict(params, RecordingUrl='https://api.twilio.com/recording'))
+        self.client.post(reverse('callrouting:transcription'),
+            dict(params, TranscriptionStatus='completed', TranscriptionText=self.text))
+
+    def test_stored_compressed(self):
+        transcript = Transcript.objects.get(call_id=self.sid)
+        self.assertLess(len(transcript.compressed_text), len(self.text) / 4)
+        self.assertEqual(transcript.text, self.text)
+        self.assertEqual(Call.objects.get(sid=self.sid).get_transcription_text(), self.text)
+
+    def test_not_loaded_with_call(self):
+        with CaptureQueriesContext(connection) as queries:
+            Call.objects.filter(sid=self.sid).select_for_update().get()
+        self.assertNotIn('transcription_text', queries[0]['sql'])
+        self.assertNotIn('callrouting_transcript', queries[0]['sql'])
+
+    def test_emailed(self):
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.text.strip(), mail.outbox[0].body)
+
+    def test_exported(self):
+        start, end = date_range(date.today() - timedelta(days=1), date.today() + timedelta(days=1))
+        rows = list(iter_calls(self.user_group, start, end))
+        self.assertEqual(rows[0]['transcription_text'], self.text)
+
+    def test_repeated_transcription(self):
+        params = {'CallSid': self.sid, 'From': '+441234000111', 'To': '+441522123456',
+                  'TranscriptionStatus': 'completed', 'TranscriptionText': self.text}
+        response = self.client.post(reverse('callrouting:transcription'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transcript.objects.get(call_id=self.sid).text, self.text)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_transcription(self):
+        sid = 'CA' + '1' * 32
+        params = {'CallSid': sid, 'From': '+441234000111', 'To': '+441522123456'}
+        self.client.post(reverse('callrouting:handle'), params)
+        self.client.post(reverse('callrouting:transcription'), dict(params, TranscriptionStatus='failed'))
+        self.assertIsNone(Call.objects.get(sid=sid).get_transcription_text())
+        self.assertFalse(Transcript.objects.filter(call_id=sid).exists())
@@ -8,6 +8,9 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('handle', views.handle, name='handle'),
     path('volunteers/<int:user_group_id>/<str:day>/<int:hour>', views.volunteers, name='volunteers'),
+    path('simulate/<int:user_group_id>', views.simulate_rota, name='simulate'),
+    path('export/<int:user_group_id>', views.export_calls, name='export'),
+    path('shifts/<str:token>.ics', views.shift_feed, name='shift_feed'),
     path('recording', views.recording, name='recording'),
     path('recordingcomplete', views.recordingcomplete, name='recordingcomplete'),
     path('transcription', views.transcription, name='transcription'),
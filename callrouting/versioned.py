@@ -0,0 +1,67 @@
+"""
+In-memory tables that each worker loads from the database and keeps until
+a version number stored in the database changes.
+
+The version is checked at most once every refresh interval, so between
+checks a lookup costs no queries at all. Whatever changes the underlying
+rows bumps the version (see models.bump_version), and every worker picks
+the change up at its next check.
+"""
+from django.conf import settings
+
+import threading
+import time
+
+
+class VersionedTable:
+    """
+    Base class for a table reloaded when state_model.version changes.
+
+    Subclasses set state_model, refresh_setting (the name of the setting
+    giving the check interval in seconds) and empty, and implement load().
+    """
+    state_model = None
+    refresh_setting = None
+    empty = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked = None
+        # Replaced in one assignment so that lookups never see a half-loaded table
+        self.table = self.empty
+
+    def invalidate(self):
+        """Make the next lookup check the version, e.g. after a local change."""
+        self.version = None
+        self.checked = None
+
+    def load(self):
+        """Return the table, freshly read from the database."""
+        raise NotImplementedError
+
+    def refresh(self, force=False):
+        """
+        Reload the table if its version has changed, checking no more often
+        than the refresh interval unless force is set.
+        """
+        interval = self.refresh_interval()
+        if not force and self.checked is not None and time.monotonic() - self.checked < interval:
+            return
+        self.reload_if_changed(force)
+
+    def refresh_interval(self):
+        return getattr(settings, self.refresh_setting, 30)
+
+    def reload_if_changed(self, force=False):
+        """
+        Check the version now, and reload the table if it has changed (or
+        force is set). If loading fails, the next check tries again.
+        """
+        with self.lock:
+            self.checked = time.monotonic()
+            version = self.state_model.objects.values_list('version', flat=True).first() or 0
+            if version == self.version and not force:
+                return
+            self.table = self.load()
+            self.version = version
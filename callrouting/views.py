@@ -1,26 +1,39 @@
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.signing import BadSignature
 
 # Create your views here.
 
 from twilio.twiml.voice_response import VoiceResponse
 from django_twilio.decorators import twilio_view
 from django_twilio.request import decompose
-from django.http import HttpResponse
-from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.db import DatabaseError, transaction
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.utils.safestring import mark_safe
 
-from callrouting.models import Shift, hour_labels, UserGroup, Call
-
-from datetime import datetime
+from callrouting.blocklist import is_blocked
+from callrouting.export import FORMATS, date_range, export_lines
+from callrouting.log import bind_log_context
+from callrouting.routing import find_user_group
+from callrouting.ical import feed_days, feed_state, render_feed, volunteer_id_from_token, window_start
+from callrouting.models import Shift, hour_labels, UserGroup, Call, Transcript, Volunteer
+from callrouting.snapshot import read_snapshot, routing_db_timeout
+from callrouting.simulation import call_demand, check_forwarded_per_hour, current_rota, parse_rota, simulate
+
+from datetime import date, datetime, timedelta
+import json
 import logging
 import pytz
-import sys
+import time
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
 def get_shifts(user_group, day, hour):
@@ -28,7 +41,8 @@ def get_shifts(user_group, day, hour):
     Return all active shifts on a given day and hour.
     """
     return Shift.objects.filter(day__exact=day, start_time__lte=hour,
-                                end_time__gt=hour, user_group__exact=user_group)
+                                end_time__gt=hour, user_group__exact=user_group
+                                ).select_related('volunteer', 'user_group').order_by('pk')
 
 def get_current_volunteer(user_group):
     """
@@ -63,6 +77,99 @@ def volunteers(request, user_group_id, day, hour):
 
     return HttpResponse(render(request, 'callrouting/volunteers.html', context))
 
+@staff_member_required
+def simulate_rota(request, user_group_id):
+    """
+    Compare the current rota with a proposed one (posted as JSON) against
+    the last year of calls.
+    """
+    user_group = UserGroup.objects.get(id=user_group_id)
+    rota = request.POST.get('rota', '')
+    forwarded_per_hour = 0.0
+    error = None
+    candidates = [('Current rota', current_rota(user_group))]
+    try:
+        forwarded_per_hour = check_forwarded_per_hour(float(request.POST.get('forwarded_per_hour') or 0))
+        if rota:
+            candidates.append(('Proposed rota', parse_rota(user_group, json.loads(rota))))
+    except (ValueError, ValidationError) as exc:
+        error = exc
+
+    end = datetime.now(pytz.timezone('Europe/London'))
+    start = end - timedelta(days=365)
+    demand = call_demand(user_group, start, end, forwarded_per_hour)
+
+    context = {
+        'user_group': user_group,
+        'start': start,
+        'end': end,
+        'rota': rota,
+        'forwarded_per_hour': forwarded_per_hour,
+        'error': error,
+        'results': [(name, simulate(user_group, shifts, demand)) for name, shifts in candidates],
+    }
+
+    return HttpResponse(render(request, 'callrouting/simulate.html', context))
+
+@staff_member_required
+def export_calls(request, user_group_id):
+    """
+    Stream the calls to a user group between the start and end dates
+    (inclusive) as CSV or JSON lines.
+    """
+    user_group = UserGroup.objects.get(id=user_group_id)
+    format = request.GET.get('format', 'csv')
+    try:
+        start_date = date.fromisoformat(request.GET['start'])
+        end_date = date.fromisoformat(request.GET['end'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('start and end dates (YYYY-MM-DD) are required')
+    if format not in FORMATS:
+        return HttpResponseBadRequest(f'format must be one of {", ".join(sorted(FORMATS))}')
+
+    start, end = date_range(start_date, end_date)
+    response = StreamingHttpResponse(export_lines(user_group, start, end, format),
+                                     content_type=FORMATS[format])
+    filename = f'calls-{user_group.id}-{start_date}-{end_date}.{format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+def shift_feed(request, token):
+    """
+    iCalendar feed of a volunteer's upcoming shifts, for calendar apps to
+    subscribe to. Returns 304 if the feed hasn't changed since the client
+    last fetched it.
+    """
+    try:
+        volunteer_id = volunteer_id_from_token(token)
+    except (BadSignature, ValueError):
+        raise Http404('No such feed')
+
+    start_date = window_start()
+    state = feed_state(volunteer_id, start_date)
+    if state is None:
+        raise Http404('No such feed')
+    etag, last_modified = state
+    etag = quote_etag(etag)
+    timestamp = int(last_modified.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        cache_key = f'shift-feed:{etag}'
+        feed = cache.get(cache_key)
+        if feed is None:
+            try:
+                volunteer = Volunteer.objects.get(id=volunteer_id)
+            except Volunteer.DoesNotExist:
+                raise Http404('No such feed')
+            shifts = Shift.objects.filter(volunteer=volunteer).select_related('user_group').order_by('pk')
+            feed = render_feed(volunteer, shifts, start_date, feed_days(), last_modified)
+            cache.set(cache_key, feed, 60 * 60 * 24)
+        response = HttpResponse(feed, content_type='text/calendar; charset=utf-8')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(timestamp)
+    return response
+
 def get_current_destination(user_group):
     """
     Get the current destination phone number.
@@ -87,8 +194,13 @@ def build_voicemail_response(user_group, twilio_request):
         logger.error(f'Error creating call object: {exc.args[0]}')
         raise
 
+    logger.info('Sending call to voicemail')
+
+    return build_record_response(user_group.voicemail_greeting)
+
+def build_record_response(voicemail_greeting):
     r = VoiceResponse()
-    r.say(user_group.voicemail_greeting, voice='woman', language='en-gb')
+    r.say(voicemail_greeting, voice='woman', language='en-gb')
     r.record(action='recording', finish_on_key='*', timeout=120,
         recording_status_callback='recordingcomplete', transcribe=True,
         transcribe_callback='transcription')
@@ -101,39 +213,111 @@ def build_response(user_group, twilio_request):
         if user_group.default_action == UserGroup.DefaultAction.VOICEMAIL:
             return build_voicemail_response(user_group, twilio_request)
         else:
+            logger.info('No volunteer on shift, forwarding call to default destination')
             dial_number = user_group.default_destination.as_e164
     else:
+        logger.info('Forwarding call to volunteer', extra={'volunteer': destination.id})
         dial_number = destination.number.as_e164
 
     greeting = user_group.greeting
     return build_forward_response(greeting, dial_number)
 
+def build_snapshot_response(twilio_request):
+    """
+    Route a call using only the on-disk routing snapshot, for when the
+    database is unavailable. Returns None if the snapshot has no route.
+    """
+    snapshot = read_snapshot()
+    user_group = snapshot.find_user_group(twilio_request.to)
+    if user_group is None:
+        return None
+
+    now = datetime.now(pytz.timezone('Europe/London'))
+    dial_number = snapshot.volunteer_number(user_group, now.strftime('%A'), now.hour)
+    if dial_number is None:
+        if user_group['default_action'] == UserGroup.DefaultAction.VOICEMAIL:
+            # There's no Call to record the voicemail against yet; the
+            # recording callbacks create it (see get_call_for_update).
+            logger.warning('Sending call to voicemail from routing snapshot')
+            return build_record_response(user_group['voicemail_greeting'])
+        dial_number = user_group['default_destination']
+
+    logger.warning('Forwarding call from routing snapshot')
+    return build_forward_response(user_group['greeting'], dial_number)
+
 @twilio_view
 def handle(request):
     twilio_request = decompose(request)
+    try:
+        with routing_db_timeout():
+            return route_call(twilio_request)
+    except DatabaseError as exc:
+        logger.error(f'Database unavailable, routing call from snapshot: {exc}')
+        try:
+            response = build_snapshot_response(twilio_request)
+        except (OSError, ValueError) as snapshot_exc:
+            logger.error(f'Could not read routing snapshot: {snapshot_exc}')
+            raise exc
+        if response is None:
+            raise
+        return response
+
+def route_call(twilio_request):
     called_number = twilio_request.to
 
-    try:
-        user_group = UserGroup.objects.get(incoming_number=called_number)
-    except UserGroup.DoesNotExist:
+    user_group = find_user_group(called_number)
+    if user_group is None:
         logger.error(f"No user group found for {called_number}")
-        raise
+        raise UserGroup.DoesNotExist(f"No user group found for {called_number}")
+
+    bind_log_context(user_group=user_group.id)
+
+    if is_blocked(user_group, twilio_request.from_):
+        logger.info('Rejecting call from blocked caller')
+        r = VoiceResponse()
+        r.reject()
+        return r
 
     return build_response(user_group, twilio_request)
 
-def get_call_for_update(sid):
-    return Call.objects.filter(sid=sid).select_for_update().get()
+def get_call_for_update(sid, twilio_request=None):
+    """
+    Fetch and lock the Call with the given sid.
+
+    A voicemail routed from the snapshot while the database was down has no
+    Call yet, so if twilio_request is given and has the called number, the
+    Call is created from it for the voicemail to be emailed as usual.
+    """
+    call = Call.objects.filter(sid=sid).select_for_update().first()
+    if call is None:
+        called_number = getattr(twilio_request, 'to', None)
+        user_group = find_user_group(called_number) if called_number else None
+        if user_group is None:
+            raise Call.DoesNotExist(f'No call {sid}, and no user group to create it for')
+        logger.warning('Creating call for voicemail routed from snapshot')
+        Call.objects.get_or_create(sid=sid, defaults={
+            'user_group': user_group,
+            'caller_number': twilio_request.from_,
+            'called_number': called_number,
+        })
+        call = Call.objects.filter(sid=sid).select_for_update().get()
+    bind_log_context(user_group=call.user_group_id)
+    return call
 
 @twilio_view
 def recording(request):
     twilio_request = decompose(request)
     with transaction.atomic():
-        call = get_call_for_update(twilio_request.callsid)
+        call = get_call_for_update(twilio_request.callsid, twilio_request)
         call.recording_begun = True
         call.save()
+    logger.info('Voicemail recording begun')
     return HttpResponse()
 
-def send_email_if_necessary(sid):
+def send_email_if_necessary(sid, transcription_text=None):
+    # transcription_text is passed in by the transcription callback, which
+    # already has it, to save fetching it again.
+
     # Phase 1: check if the conditions for sending the email are met:
     # - We should have received both the recording and the transcription
     # - We should not have already attempted to send the email
@@ -152,10 +336,15 @@ def send_email_if_necessary(sid):
 
             # The transcription may not be available if it failed for some reason
             transcription_successful = call.transcription_successful
-            if call.transcription_successful:
-                transcription_text = call.transcription_text
+            if call.transcription_successful and transcription_text is None:
+                transcription_text = call.get_transcription_text()
         else:
             # Don't do anything right now
+            logger.info('Not sending voicemail email yet', extra={
+                'recording_received': call.recording_received,
+                'transcription_received': call.transcription_received,
+                'email_attempted': call.email_attempted,
+            })
             return
 
     # Phase 2: email the recording and transaction to the user group message email
@@ -180,7 +369,12 @@ def send_email_if_necessary(sid):
     html_message = render_to_string('callrouting/voicemail_email.html', context)
     sender = 'Community Line <communityline@domain.local>'
 
+    start = time.monotonic()
     send_mail(subject, text_message, sender, [receiver], html_message=html_message, fail_silently=False)
+    logger.info('Voicemail email sent', extra={
+        'transcription_successful': transcription_successful,
+        'email_ms': round((time.monotonic() - start) * 1000, 3),
+    })
 
     # Phase 3: record that we successfully sent the mail if we get here
     with transaction.atomic():
@@ -194,10 +388,11 @@ def recordingcomplete(request):
     sid = twilio_request.callsid
 
     with transaction.atomic():
-        call = get_call_for_update(sid)
+        call = get_call_for_update(sid, twilio_request)
         call.recording_received = True
         call.recording_url = twilio_request.recordingurl
         call.save()
+    logger.info('Voicemail recording received')
 
     send_email_if_necessary(sid)
 
@@ -208,18 +403,26 @@ def transcription(request):
     twilio_request = decompose(request)
     sid = twilio_request.callsid
 
+    transcription_text = None
     with transaction.atomic():
-        call = get_call_for_update(sid)
+        call = get_call_for_update(sid, twilio_request)
         call.transcription_received = True
         if twilio_request.transcriptionstatus == 'completed':
             call.transcription_successful = True
-            call.transcription_text = twilio_request.transcriptiontext
+            transcription_text = twilio_request.transcriptiontext or ''
+            # A single INSERT; if Twilio retries, the Transcript stored the
+            # first time is kept.
+            Transcript.objects.bulk_create(
+                [Transcript(call=call, compressed_text=Transcript.compress(transcription_text))],
+                ignore_conflicts=True)
         else:
             # Being a bit explicit about the fact that this field should be False here.
             call.transcription_successful = False
         call.save()
+    logger.info('Voicemail transcription received',
+                extra={'transcription_status': twilio_request.transcriptionstatus})
 
-    send_email_if_necessary(sid)
+    send_email_if_necessary(sid, transcription_text)
 
     return HttpResponse()
 
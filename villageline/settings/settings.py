@@ -29,9 +29,28 @@ DEBUG = False
 # Forgery protection off at present as we only tell Twilio what to dial in a response.
 DJANGO_TWILIO_FORGERY_PROTECTION = False
 
-# We're not using blacklists, so save a database query
+# django_twilio's blacklist costs a database query on every request. Callers
+# are blocked by callrouting.blocklist instead, which is held in memory.
 DJANGO_TWILIO_BLACKLIST_CHECK = False
 
+# How often each worker checks whether the caller blocklist has changed.
+BLOCKLIST_REFRESH_SECONDS = 30
+
+# How often each worker checks whether the incoming number routing has changed.
+ROUTING_REFRESH_SECONDS = 30
+
+# How many days ahead volunteers' calendar feeds of their shifts cover.
+SHIFT_FEED_DAYS = 28
+
+# Calls are routed from this snapshot file if the database doesn't answer
+# within ROUTING_DB_TIMEOUT_MS (PostgreSQL only; also set a connect_timeout
+# in the database OPTIONS so that an unreachable database fails fast).
+# The file is local to each host: every web dyno runs writeroutingsnapshot
+# --watch (see Procfile) to keep its own copy up to date, and a host that has
+# never reached the database since it started has no snapshot to fall back on.
+ROUTING_SNAPSHOT_PATH = os.path.join(BASE_DIR, 'routing-snapshot.json')
+ROUTING_DB_TIMEOUT_MS = 2000
+
 ALLOWED_HOSTS = []
 
 
@@ -51,6 +70,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'callrouting.log.RequestLogMiddleware',
+    'callrouting.budgets.BudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -112,6 +133,31 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Logging
+# Records are queued and written as JSON lines to stdout by a background
+# thread, so slow log output never delays a response to Twilio.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'log_context': {
+            '()': 'callrouting.log.LogContextFilter',
+        },
+    },
+    'handlers': {
+        'queue': {
+            '()': 'callrouting.log.queue_handler',
+            'filters': ['log_context'],
+        },
+    },
+    'root': {
+        'handlers': ['queue'],
+        'level': 'INFO',
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 